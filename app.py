@@ -1,23 +1,27 @@
+import os
 from flask import Flask, Response, request, jsonify
 import cv2
 import numpy as np
 import threading
 import time
-import os
 import json
+import functools
 from pathlib import Path
 import logging
 import queue
 from typing import Dict, List, Set, Tuple, Optional
-import torch
 from flask_cors import CORS
 
-from vision import YOLODetector, DummyModel
+from vision import DummyModel, BatchedDetectorWorker
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("vms")
 
+# Every stream already runs in its own threads, so keep OpenCV's internal thread pool
+# from oversubscribing the cores on top of them
+cv2.setNumThreads(1)
+
 app = Flask(__name__)
 # Enable CORS for frontend integration
 CORS(app)
@@ -28,38 +32,59 @@ CONFIG = {
     "detection": {
         "enabled": True,
         "model_path": "models/yolov5s.pt",
+        "engine_path": "models/yolov5s.engine",
+        "int8_engine_path": "models/yolov5s.int8.engine",
+        "int8": False,  # Build an INT8 engine calibrated on frames from video_dir
         "confidence": 0.4,
-        "process_every_n_frames": 4  # Increased to reduce CPU load
+        "process_every_n_frames": 4,  # Increased to reduce CPU load
+        "target_fps": None,  # e.g. 5: detector runs per second and stream instead, when the source frame rate is known
+        "max_batch": 16,  # Frames from different streams run through the model together
+        "max_batch_wait": 0.01,  # Seconds a batch waits for more frames after the first arrives
+        "motion_gate_enabled": True,  # Skip the detector on frames without motion...
+        "motion_gate_max_age": 2.0,  # ...as long as the last detections are younger than this (seconds)
+        "worker_cpus": None  # e.g. [0, 1, 2, 3] to pin the batched detector thread to one socket
     },
     "motion": {
         "enabled": True,
         "threshold": 25,
-        "contour_area": 300
+        "contour_area": 300,
+        "idle_threshold": 15,  # Max pixel change (0-255) for a frame to count as idle and skip background subtraction
+        "use_cuda": True  # Run background subtraction on the GPU when OpenCV is built with CUDA
+    },
+    "capture": {
+        "hw_decode": True  # Decode H.264 with NVDEC or VA-API through GStreamer when available
+    },
+    "server": {
+        "feed_port": 5001,  # Async MJPEG feed server, used when aiohttp is installed
+        "feed_url": None,  # Public base URL of the feed server (e.g. behind a reverse proxy), default: this host on feed_port
+        "jpeg_quality": 80  # Quality of the annotated frames sent to snapshots and video feeds
     },
     "video_dir": "videos"
 }
 
 # Global state
 streams = {}
+# Held while reserving or adding a stream id so concurrent loads can't start it twice. Ids
+# whose capture is still opening sit in starting_streams, so the lock is never held across
+# a (possibly slow) open. Readers iterate over a list() copy of streams instead of taking it
+streams_lock = threading.Lock()
+starting_streams = set()
 detections = {}
 
-# Create a single, shared object detector
-try:
-    object_detector = YOLODetector(
-        model_path=CONFIG["detection"]["model_path"],
-        confidence=CONFIG["detection"]["confidence"]
-    )
-except Exception as e:
-    logger.error(f"Failed to load YOLO model: {e}")
-    # Fallback to a dummy model if loading fails
-    object_detector = DummyModel()
+# Seconds a directory scan is reused before the videos directory is globbed again
+VIDEO_SCAN_TTL = 30
 
 # Function to discover video files in the specified directory
 def discover_videos(directory="videos") -> List[Dict]:
     """
-    Discover video files in the specified directory
+    Discover video files in the specified directory, rescanning at most every VIDEO_SCAN_TTL seconds
     Returns: List of dictionaries with video information
     """
+    # The time bucket is part of the cache key, so entries expire when it rolls over
+    return list(_scan_videos(directory, int(time.time() // VIDEO_SCAN_TTL)))
+
+@functools.lru_cache(maxsize=16)
+def _scan_videos(directory, ttl_bucket):
     video_files = []
     supported_formats = ['.mp4', '.avi', '.mov', '.mkv']
     
@@ -83,6 +108,55 @@ def discover_videos(directory="videos") -> List[Dict]:
     
     return video_files
 
+# Create a single, shared object detector
+object_detector = None
+
+# Prefer the TensorRT engine when a CUDA device is available
+try:
+    from vision import TRTYOLODetector, TRT_AVAILABLE, cuda_available
+    if TRT_AVAILABLE and cuda_available():
+        object_detector = TRTYOLODetector(
+            model_path=CONFIG["detection"]["model_path"],
+            confidence=CONFIG["detection"]["confidence"],
+            engine_path=CONFIG["detection"]["engine_path"],
+            int8_engine_path=CONFIG["detection"]["int8_engine_path"],
+            calibration_videos=(
+                [video["url"] for video in discover_videos(CONFIG["video_dir"])]
+                if CONFIG["detection"]["int8"] else None
+            )
+        )
+except Exception as e:
+    logger.error(f"Failed to load TensorRT engine, falling back to PyTorch: {e}")
+
+if object_detector is None:
+    # All detection runs on the batched worker thread, so torch's intra-op pool is what
+    # spreads a batch over the cores. When the worker is pinned, size the pool to its CPUs
+    # (OpenMP reads this when torch loads); otherwise leave torch's default
+    worker_cpus = CONFIG["detection"]["worker_cpus"]
+    if worker_cpus:
+        os.environ["OMP_NUM_THREADS"] = str(len(worker_cpus))
+    try:
+        # Imports torch on first use; an ImportError falls through to the dummy model
+        from vision import YOLODetector
+        object_detector = YOLODetector(
+            model_path=CONFIG["detection"]["model_path"],
+            confidence=CONFIG["detection"]["confidence"],
+            num_threads=len(worker_cpus) if worker_cpus else None
+        )
+    except Exception as e:
+        logger.error(f"Failed to load YOLO model: {e}")
+        # Fallback to a dummy model if loading fails
+        object_detector = DummyModel()
+
+# A single worker runs object detection for all streams in batches
+detection_worker = BatchedDetectorWorker(
+    object_detector,
+    max_batch=CONFIG["detection"]["max_batch"],
+    max_wait=CONFIG["detection"]["max_batch_wait"],
+    cpus=CONFIG["detection"]["worker_cpus"]
+)
+detection_worker.start()
+
 # Add this to ensure streams get initialized when the app starts
 @app.before_request
 def before_request():
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+# aiohttp is optional - without it video feeds are served by the Flask route
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+from app import streams, logger
+
+# Port the async feed server is listening on, None while it is not running
+feed_port = None
+
+async def video_feed(request):
+    """
+    MJPEG feed for one stream. Each viewer is a coroutine woken by the stream's JPEG
+    publications, so an open feed costs a socket instead of a server thread
+    """
+    stream_id = request.match_info["stream_id"]
+    processor = streams.get(stream_id)
+    if processor is None:
+        return web.json_response({"error": f"Stream {stream_id} not found"}, status=404)
+
+    loop = asyncio.get_running_loop()
+    published = asyncio.Event()
+
+    def on_publish():
+        # Called from the stream's annotate thread on every publish, and from whichever
+        # thread stops the stream
+        loop.call_soon_threadsafe(published.set)
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "multipart/x-mixed-replace; boundary=frame",
+        "Access-Control-Allow-Origin": "*"
+    })
+    await response.prepare(request)
+
+    processor.add_jpeg_listener(on_publish)
+    try:
+        last_seq = -1
+        while streams.get(stream_id) is processor and processor.running:
+            # Clear before reading so a publish in between still wakes the next wait
+            published.clear()
+            jpeg, seq = processor.get_latest_jpeg()
+            if jpeg and seq != last_seq:
+                last_seq = seq
+                await response.write(b'--frame\r\n'
+                                     b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+            try:
+                await asyncio.wait_for(published.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+    except ConnectionResetError:
+        pass  # Viewer went away
+    finally:
+        processor.remove_jpeg_listener(on_publish)
+    return response
+
+def start_feed_server(host="0.0.0.0", port=5001):
+    """
+    Serve video feeds from an aiohttp app on its own event loop thread
+    Returns: True if the server was started, False if aiohttp is missing or the port can't be bound
+    """
+    if web is None:
+        logger.info("aiohttp not installed, video feeds are served by the Flask app")
+        return False
+
+    feed_app = web.Application()
+    feed_app.router.add_get("/api/streams/{stream_id}/video_feed", video_feed)
+    runner = web.AppRunner(feed_app)
+    started = threading.Event()
+
+    def run():
+        global feed_port
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, host, port).start())
+            feed_port = port
+        except Exception as e:
+            logger.error(f"Failed to start video feed server on port {port}: {str(e)}")
+            return
+        finally:
+            started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+    if feed_port is not None:
+        logger.info(f"Video feeds served asynchronously on port {port}")
+    return feed_port is not None
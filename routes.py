@@ -1,23 +1,47 @@
-from flask import Blueprint, Response, request, jsonify, send_file
-import cv2
+from flask import Blueprint, Response, request, jsonify, send_file, redirect
 import numpy as np
 import json
 import time
 import io
 from PIL import Image
 import threading
+import atexit
 import os
 from pathlib import Path
+from urllib.parse import urlsplit
 
-from app import app, CONFIG, streams, detections, logger, discover_videos, object_detector
-from vision import StreamProcessor
+from app import app, CONFIG, streams, streams_lock, starting_streams, detections, logger, discover_videos, detection_worker
+from vision import StreamProcessor, materialize_result
+import feeds
+
+def start_stream(stream_id, url):
+    """
+    Start a processor for stream_id and add it to streams. The id is reserved under streams_lock,
+    but the capture is opened outside it so a slow camera doesn't hold up other streams
+    Returns: "started", "exists" if the id is loaded or still starting, or "failed"
+    """
+    with streams_lock:
+        if stream_id in streams or stream_id in starting_streams:
+            return "exists"
+        starting_streams.add(stream_id)
+        
+    processor = StreamProcessor(stream_id, url, CONFIG, detection_worker)
+    success = False
+    try:
+        success = processor.start()
+    finally:
+        with streams_lock:
+            starting_streams.discard(stream_id)
+            if success:
+                streams[stream_id] = processor
+    return "started" if success else "failed"
 
 # Define routes
 @app.route('/api/streams', methods=['GET'])
 def get_streams():
     """Get all configured streams"""
     response = []
-    for stream_id, processor in streams.items():
+    for stream_id, processor in list(streams.items()):
         response.append(processor.get_status())
     return jsonify(response)
 
@@ -32,19 +56,11 @@ def add_stream():
     stream_id = data.get('id', str(int(time.time())))
     url = data['url']
     
-    if stream_id in streams:
+    status = start_stream(stream_id, url)
+    if status == "exists":
         return jsonify({"error": f"Stream with ID {stream_id} already exists"}), 400
-        
-    # Create stream processor
-    processor = StreamProcessor(stream_id, url, CONFIG, object_detector)
-    
-    # Start the stream
-    success = processor.start()
-    if not success:
+    if status == "failed":
         return jsonify({"error": f"Failed to start stream: {url}"}), 400
-        
-    # Add to streams dict
-    streams[stream_id] = processor
     
     # Update config
     CONFIG["streams"][stream_id] = {"url": url}
@@ -54,14 +70,14 @@ def add_stream():
 @app.route('/api/streams/<stream_id>', methods=['DELETE'])
 def delete_stream(stream_id):
     """Delete a stream"""
-    if stream_id not in streams:
+    # Remove from streams dict
+    with streams_lock:
+        processor = streams.pop(stream_id, None)
+    if processor is None:
         return jsonify({"error": f"Stream {stream_id} not found"}), 404
         
     # Stop the stream
-    streams[stream_id].stop()
-    
-    # Remove from streams dict
-    del streams[stream_id]
+    processor.stop()
     
     # Update config
     if stream_id in CONFIG["streams"]:
@@ -87,12 +103,8 @@ def get_stream_detections(stream_id):
     if result is None:
         return jsonify({"detections": []})
         
-    # Remove the frame from the result to reduce response size
-    result_copy = result.copy()
-    if "frame" in result_copy:
-        del result_copy["frame"]
-        
-    return jsonify(result_copy)
+    # Only the detections are returned, built from the result arrays on demand
+    return jsonify(materialize_result(result))
 
 @app.route('/api/streams/<stream_id>/snapshot', methods=['GET'])
 def get_stream_snapshot(stream_id):
@@ -100,20 +112,10 @@ def get_stream_snapshot(stream_id):
     if stream_id not in streams:
         return jsonify({"error": f"Stream {stream_id} not found"}), 404
         
-    # Get the latest frame with detections
-    result = streams[stream_id].get_latest_result()
-    
-    if result is None or "frame" not in result:
-        # Fallback to raw frame
-        frame = streams[stream_id].get_latest_frame()
-    else:
-        frame = result["frame"]
+    # Already-encoded annotated frame, or rendered now if annotation was idle
+    jpeg = streams[stream_id].get_snapshot_jpeg()
         
-    # Convert to JPEG
-    _, buffer = cv2.imencode('.jpg', frame)
-    io_buf = io.BytesIO(buffer)
-    
-    return send_file(io_buf, mimetype='image/jpeg')
+    return send_file(io.BytesIO(jpeg), mimetype='image/jpeg')
 
 @app.route('/api/streams/<stream_id>/video_feed')
 def video_feed(stream_id):
@@ -121,20 +123,32 @@ def video_feed(stream_id):
     if stream_id not in streams:
         return jsonify({"error": f"Stream {stream_id} not found"}), 404
         
+    # Hand the viewer to the async feed server when it runs, so the feed doesn't hold a thread here
+    if feeds.feed_port is not None:
+        feed_url = CONFIG["server"].get("feed_url")
+        if not feed_url:
+            host = urlsplit(request.host_url).hostname
+            if ":" in host:
+                host = f"[{host}]"  # IPv6
+            feed_url = f"{request.scheme}://{host}:{feeds.feed_port}"
+        url = feed_url.rstrip("/") + request.path
+        if request.query_string:
+            url += "?" + request.query_string.decode()
+        return redirect(url, code=307)
+        
+    processor = streams[stream_id]
+        
     def generate():
-        while streams.get(stream_id) and streams[stream_id].running:
-            result = streams[stream_id].get_latest_result()
-            
-            if result is None or "frame" not in result:
-                # Fallback to raw frame
-                frame = streams[stream_id].get_latest_frame()
-            else:
-                frame = result["frame"]
+        last_seq = -1
+        while streams.get(stream_id) is processor and processor.running:
+            # Wait for the next frame the detection thread encodes
+            jpeg, last_seq = processor.wait_for_jpeg(last_seq)
+            # None on timeout, empty before the stream's first JPEG
+            if not jpeg:
+                continue
                 
-            # Convert to JPEG
-            _, buffer = cv2.imencode('.jpg', frame)
             yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+                   b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
             
     return Response(generate(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
@@ -161,7 +175,7 @@ def update_config():
         CONFIG["motion"].update(data["motion"])
         
     # Apply changes to existing streams
-    for stream_id, processor in streams.items():
+    for stream_id, processor in list(streams.items()):
         processor.config = CONFIG
         
     return jsonify(CONFIG)
@@ -169,10 +183,11 @@ def update_config():
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     """Get system statistics"""
+    processors = list(streams.values())
     stats = {
-        "total_streams": len(streams),
-        "active_streams": sum(1 for s in streams.values() if s.running),
-        "streams": [s.get_status() for s in streams.values()]
+        "total_streams": len(processors),
+        "active_streams": sum(1 for s in processors if s.running),
+        "streams": [s.get_status() for s in processors]
     }
     return jsonify(stats)
 
@@ -185,27 +200,19 @@ def get_videos():
 @app.route('/api/videos/<video_id>/load', methods=['POST'])
 def load_video(video_id):
     """Load a specific video from the videos directory"""
-    videos = discover_videos(CONFIG["video_dir"])
+    videos = {v["id"]: v for v in discover_videos(CONFIG["video_dir"])}
     
     # Find the video with the given ID
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = videos.get(video_id)
     if not video:
         return jsonify({"error": f"Video {video_id} not found"}), 404
     
-    # Check if this video is already loaded as a stream
-    if video_id in streams:
+    status = start_stream(video_id, video["url"])
+    if status == "exists":
         return jsonify({"error": f"Video {video_id} is already loaded", "stream_id": video_id}), 400
-    
-    # Create stream processor and start it
-    processor = StreamProcessor(video_id, video["url"], CONFIG, object_detector)
-    success = processor.start()
-    
-    if not success:
+    if status == "failed":
         return jsonify({"error": f"Failed to start video stream: {video['url']}"}), 400
     
-    # Add to streams dict
-    streams[video_id] = processor
-    
     # Update config
     CONFIG["streams"][video_id] = {"url": video["url"]}
     
@@ -218,23 +225,14 @@ def load_all_videos():
     results = []
     
     for video in videos:
-        # Skip already loaded videos
-        if video["id"] in streams:
-            results.append({"id": video["id"], "status": "already_loaded", "name": video["name"]})
-            continue
-            
-        # Create stream processor and start it
-        processor = StreamProcessor(video["id"], video["url"], CONFIG, object_detector)
-        success = processor.start()
-        
-        if success:
-            # Add to streams dict
-            streams[video["id"]] = processor
+        status = start_stream(video["id"], video["url"])
+        if status == "exists":
+            # Skip already loaded videos
+            status = "already_loaded"
+        elif status == "started":
             # Update config
             CONFIG["streams"][video["id"]] = {"url": video["url"]}
-            results.append({"id": video["id"], "status": "started", "name": video["name"]})
-        else:
-            results.append({"id": video["id"], "status": "failed", "name": video["name"]})
+        results.append({"id": video["id"], "status": status, "name": video["name"]})
     
     return jsonify(results)
 
@@ -242,22 +240,22 @@ def load_all_videos():
 # with a function that can be called directly
 def initialize_streams():
     # First, load any streams from the config
-    for stream_id, stream_config in CONFIG["streams"].items():
-        if stream_id not in streams:
-            processor = StreamProcessor(stream_id, stream_config["url"], CONFIG, object_detector)
-            success = processor.start()
-            if success:
-                streams[stream_id] = processor
+    for stream_id, stream_config in list(CONFIG["streams"].items()):
+        start_stream(stream_id, stream_config["url"])
     
     # Then, discover and auto-load videos if there are no streams yet
     if not streams:
         videos = discover_videos(CONFIG["video_dir"])
         for video in videos:
-            if video["id"] not in streams:
-                processor = StreamProcessor(video["id"], video["url"], CONFIG, object_detector)
-                success = processor.start()
-                if success:
-                    streams[video["id"]] = processor
+            start_stream(video["id"], video["url"])
+
+def shutdown_streams():
+    """Stop every stream and the detector so no thread is still inside OpenCV when the interpreter exits"""
+    for processor in list(streams.values()):
+        processor.stop()
+    detection_worker.stop()
 
-# Call initialize_streams at startup
-initialize_streams()
\ No newline at end of file
+# Start streams in the background so the server can bind without waiting for every capture to open.
+# Not a daemon thread: interrupting it inside cv2.VideoCapture() at exit aborts the process
+threading.Thread(target=initialize_streams).start()
+atexit.register(shutdown_streams)
\ No newline at end of file
@@ -35,5 +35,9 @@ if __name__ == "__main__":
     print("API will be available at http://localhost:5000")
     print("Videos will be automatically loaded and processed")
     
+    # Video feeds are long-lived, serve them from an event loop instead of waitress threads
+    from feeds import start_feed_server
+    start_feed_server(host='0.0.0.0', port=CONFIG["server"]["feed_port"])
+    
     # Run the Flask app
     serve(app, host='0.0.0.0', port=5000, threads=32)
\ No newline at end of file
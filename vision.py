@@ -1,49 +1,360 @@
 import cv2
-import torch
 import numpy as np
 import time
 import threading
-from queue import Queue
+import queue
 import logging
 import os
 from pathlib import Path
 import sys
+import ctypes
+
+# TensorRT and the CUDA runtime bindings are optional - only needed for TRTYOLODetector
+try:
+    import tensorrt as trt
+    from cuda import cudart
+except ImportError:
+    trt = None
+    cudart = None
+
+# PyTurboJPEG is optional - libjpeg-turbo's SIMD encoder is used for JPEG output when present
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
+# Numba is optional - it JIT-compiles the per-contour motion post-processing
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 logger = logging.getLogger("vms.models")
 
+# Low-latency FFmpeg demuxing for network streams: RTSP over TCP and no input buffering.
+# OpenCV reads this on every open, so it only has to be in place before the first capture
+os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", "rtsp_transport;tcp|fflags;nobuffer|flags;low_delay")
+
+TRT_AVAILABLE = trt is not None and cudart is not None
+
+def cuda_available():
+    """True if a CUDA device is visible, checked through the CUDA runtime rather than torch"""
+    if cudart is None:
+        return False
+    err, count = cudart.cudaGetDeviceCount()
+    return err == cudart.cudaError_t.cudaSuccess and count > 0
+
+def cv_cuda_available():
+    """True if OpenCV was built with CUDA (and the cudabgsegm module) and sees a device"""
+    try:
+        return (cv2.cuda.getCudaEnabledDeviceCount() > 0
+                and hasattr(cv2.cuda, "createBackgroundSubtractorMOG2"))
+    except (AttributeError, cv2.error):
+        return False
+
+# COCO class names, used by detectors that don't carry the hub model's metadata
+COCO_NAMES = [
+    "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat",
+    "traffic light", "fire hydrant", "stop sign", "parking meter", "bench", "bird", "cat",
+    "dog", "horse", "sheep", "cow", "elephant", "bear", "zebra", "giraffe", "backpack",
+    "umbrella", "handbag", "tie", "suitcase", "frisbee", "skis", "snowboard", "sports ball",
+    "kite", "baseball bat", "baseball glove", "skateboard", "surfboard", "tennis racket",
+    "bottle", "wine glass", "cup", "fork", "knife", "spoon", "bowl", "banana", "apple",
+    "sandwich", "orange", "broccoli", "carrot", "hot dog", "pizza", "donut", "cake", "chair",
+    "couch", "potted plant", "bed", "dining table", "toilet", "tv", "laptop", "mouse",
+    "remote", "keyboard", "cell phone", "microwave", "oven", "toaster", "sink",
+    "refrigerator", "book", "clock", "vase", "scissors", "teddy bear", "hair drier",
+    "toothbrush"
+]
+
+def letterbox(frame, new_size=640, color=(114, 114, 114)):
+    """
+    Resize a frame to new_size x new_size keeping the aspect ratio, padding the rest
+    Returns: (padded image, scale ratio, (pad_x, pad_y))
+    """
+    h, w = frame.shape[:2]
+    ratio = min(new_size / h, new_size / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    pad_x, pad_y = (new_size - new_w) / 2, (new_size - new_h) / 2
+    
+    if (w, h) != (new_w, new_h):
+        frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    padded = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+    return padded, ratio, (pad_x, pad_y)
+
+def preprocess(frame, size=640, raw=False):
+    """
+    Turn a BGR frame into the detector input: letterboxed, RGB, normalized (3, size, size) float16.
+    With raw=True just the letterboxed BGR (size, size, 3) uint8 image, for detectors that
+    convert on the device
+    Returns: dict with the tensor plus the frame shape and letterbox transform needed to decode boxes
+    """
+    image, ratio, pad = letterbox(frame, size)
+    if raw:
+        tensor = image
+    else:
+        # blobFromImage does the channel swap, HWC -> CHW transpose and 1/255 scaling in one pass
+        tensor = cv2.dnn.blobFromImage(image, 1 / 255.0, swapRB=True)[0].astype(np.float16)
+    return {"tensor": tensor, "shape": frame.shape, "ratio": ratio, "pad": pad}
+
+# Box colors (BGR): green for people / objects, red for motion
+OBJECT_COLOR = (0, 255, 0)
+MOTION_COLOR = (0, 0, 255)
+
+# Detections are passed around as parallel arrays (bboxes, confs, types) rather than
+# per-detection dicts; types holds the model's class id, or MOTION_TYPE for motion regions
+MOTION_TYPE = 255
+
+# Per-type lookup tables, indexed directly with a types array instead of branching per detection
+COLOR_TABLE = np.tile(np.array(OBJECT_COLOR, dtype=np.uint8), (256, 1))
+COLOR_TABLE[MOTION_TYPE] = MOTION_COLOR
+LABEL_TABLE = np.full(256, "unknown", dtype=object)
+
+def set_label_names(names):
+    """
+    Fill LABEL_TABLE from a model's class names, a list or an {id: name} dict like
+    YOLOv5's model.names. Ids that don't fit below MOTION_TYPE keep the "unknown" label
+    """
+    if isinstance(names, dict):
+        names = [names.get(i, "unknown") for i in range(max(names, default=-1) + 1)]
+    names = list(names)[:MOTION_TYPE]
+    LABEL_TABLE[:] = "unknown"
+    LABEL_TABLE[:len(names)] = names
+    LABEL_TABLE[MOTION_TYPE] = "motion"
+
+# COCO until a model with its own names is loaded (the TensorRT engine and dummy model keep these)
+set_label_names(COCO_NAMES)
+
+def make_detections(bboxes=(), confs=(), types=()):
+    """Build a detection set from bbox (K, 4), confidence (K,) and type (K,) sequences"""
+    return {
+        "bboxes": np.asarray(bboxes, dtype=np.int16).reshape(-1, 4),
+        "confs": np.asarray(confs, dtype=np.float32).reshape(-1),
+        "types": np.asarray(types, dtype=np.uint8).reshape(-1)
+    }
+
+def concat_detections(*detection_sets):
+    """Merge several detection sets into one"""
+    return {
+        key: np.concatenate([d[key] for d in detection_sets])
+        for key in ("bboxes", "confs", "types")
+    }
+
+def detections_to_list(detections):
+    """Materialize a detection set as the list of {bbox, confidence, label} dicts used by the API"""
+    return [
+        {"bbox": bbox, "confidence": conf, "label": label}
+        for bbox, conf, label in zip(detections["bboxes"].tolist(),
+                                     detections["confs"].tolist(),
+                                     LABEL_TABLE[detections["types"]].tolist())
+    ]
+
+def materialize_result(result):
+    """Convert a stream result into the JSON response shape, split into detections and motion"""
+    detections = result["detections"]
+    is_motion = detections["types"] == MOTION_TYPE
+    return {
+        "timestamp": result["timestamp"],
+        "detections": detections_to_list({k: v[~is_motion] for k, v in detections.items()}),
+        "motion": detections_to_list({k: v[is_motion] for k, v in detections.items()})
+    }
+
+def decode_yolo_output(pred, frame_shape, ratio, pad, conf_thres=0.3, iou_thres=0.45, classes=None):
+    """
+    Decode raw YOLOv5 output rows (cx, cy, w, h, obj, cls...) for a single image into
+    a detection set, undoing the letterbox transform
+    """
+    # Cheap objectness filter first so the rest only touches candidate rows
+    pred = pred[pred[:, 4] > conf_thres]
+    if len(pred) == 0:
+        return make_detections()
+        
+    class_scores = pred[:, 5:] * pred[:, 4:5]
+    class_ids = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(pred)), class_ids]
+    keep = scores > conf_thres
+    if classes is not None:
+        keep &= np.isin(class_ids, classes)
+    pred, class_ids, scores = pred[keep], class_ids[keep], scores[keep]
+    if len(pred) == 0:
+        return make_detections()
+        
+    # Center xywh in letterboxed space -> corner xyxy in original frame space
+    boxes = np.empty((len(pred), 4), dtype=np.float32)
+    boxes[:, 0] = (pred[:, 0] - pred[:, 2] / 2 - pad[0]) / ratio
+    boxes[:, 1] = (pred[:, 1] - pred[:, 3] / 2 - pad[1]) / ratio
+    boxes[:, 2] = (pred[:, 0] + pred[:, 2] / 2 - pad[0]) / ratio
+    boxes[:, 3] = (pred[:, 1] + pred[:, 3] / 2 - pad[1]) / ratio
+    h, w = frame_shape[:2]
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    
+    # Offset boxes per class so NMS never suppresses across classes
+    offsets = class_ids[:, None].astype(np.float32) * 4096
+    nms_boxes = np.concatenate([boxes[:, :2] + offsets, boxes[:, 2:] - boxes[:, :2]], axis=1)
+    indices = np.array(
+        cv2.dnn.NMSBoxes(nms_boxes.tolist(), scores.tolist(), conf_thres, iou_thres)
+    ).reshape(-1)
+    return make_detections(boxes[indices], scores[indices], class_ids[indices])
+
+if njit is not None:
+    # Serial and GIL-free rather than parallel=True: it is called concurrently from every
+    # stream's annotate thread, which Numba's default parallel backend does not support
+    @njit(nogil=True, cache=True)
+    def draw_boxes(img, bboxes, colors):
+        """Draw 2px rectangle outlines for all bboxes (K, 4) in colors (K, 3) straight into img"""
+        h, w = img.shape[0], img.shape[1]
+        for k in range(len(bboxes)):
+            x1 = min(max(bboxes[k, 0], 0), w)
+            y1 = min(max(bboxes[k, 1], 0), h)
+            x2 = min(max(bboxes[k, 2], 0), w)
+            y2 = min(max(bboxes[k, 3], 0), h)
+            for c in range(3):
+                img[y1:min(y1 + 2, h), x1:x2, c] = colors[k, c]
+                img[max(y2 - 2, 0):y2, x1:x2, c] = colors[k, c]
+                img[y1:y2, x1:min(x1 + 2, w), c] = colors[k, c]
+                img[y1:y2, max(x2 - 2, 0):x2, c] = colors[k, c]
+else:
+    def draw_boxes(img, bboxes, colors):
+        """Draw 2px rectangle outlines for all bboxes (K, 4) in colors (K, 3) straight into img"""
+        for (x1, y1, x2, y2), color in zip(bboxes.tolist(), colors.tolist()):
+            cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+
+def component_boxes(mask, min_area):
+    """Bounding boxes (K, 4) of the 8-connected foreground components larger than min_area pixels"""
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    stats = stats[1:]  # Label 0 is the background
+    stats = stats[stats[:, cv2.CC_STAT_AREA] > min_area]
+    boxes = stats[:, [cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT]]
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes
+
+_jpeg = None
+if TurboJPEG is not None:
+    try:
+        _jpeg = TurboJPEG()
+    except Exception as e:
+        logger.warning(f"libjpeg-turbo not usable, falling back to OpenCV JPEG encoding: {e}")
+
+def encode_jpeg(frame, quality=80):
+    """Encode a BGR frame to JPEG bytes, using libjpeg-turbo when available"""
+    if _jpeg is not None:
+        return _jpeg.encode(frame, quality=quality, pixel_format=TJPF_BGR)
+    _, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes()
+
+def _cuda_call(call):
+    """Unwrap a cuda-python (err, *values) return tuple, raising on error"""
+    err, *values = call
+    if err != cudart.cudaError_t.cudaSuccess:
+        raise RuntimeError(f"CUDA runtime error: {err}")
+    if not values:
+        return None
+    return values[0] if len(values) == 1 else values
+
 class MotionDetector:
-    def __init__(self, threshold=25, min_contour_area=500):
+    def __init__(self, threshold=25, min_contour_area=500, work_width=320, update_every=4, use_cuda=True,
+                 idle_threshold=15):
         self.threshold = 15  # Lowered for increased sensitivity
         self.min_contour_area = 200  # Lowered to detect smaller objects
-        self.background_subtractor = cv2.createBackgroundSubtractorMOG2(
-            history=100, varThreshold=50, detectShadows=True
-        )
+        # A frame whose pixels all changed by at most this much from the last one the
+        # background model saw is idle, and skips background subtraction
+        self.idle_threshold = idle_threshold
+        # Background subtraction runs on a grayscale copy downscaled to work_width pixels wide
+        # (e.g. 320x180 for 1080p), so its cost is the same whatever the source resolution
+        self.work_width = work_width
+        # The background model is only updated every N calls, reusing the last mask in between
+        self.update_every = update_every
+        self.frame_counter = 0
+        self.fg_mask = None
+        self.motion_boxes = None
+        # Grayscale frame the background model last saw, for skipping it on idle scenes
+        self.reference_gray = None
+        # With a CUDA build of OpenCV, resize, MOG2 and threshold run on the GPU and only
+        # the small mask comes back for the connected components pass
+        self.use_cuda = use_cuda and cv_cuda_available()
+        if self.use_cuda:
+            self.stream = cv2.cuda_Stream()
+            self.gpu_frame = cv2.cuda_GpuMat()
+            self.background_subtractor = cv2.cuda.createBackgroundSubtractorMOG2(
+                history=50, varThreshold=50, detectShadows=False
+            )
+        else:
+            self.background_subtractor = cv2.createBackgroundSubtractorMOG2(
+                history=50, varThreshold=50, detectShadows=False
+            )
         
     def detect(self, frame):
-        # Apply background subtraction
-        fg_mask = self.background_subtractor.apply(frame)
+        # Apply background subtraction; boxes only change when the mask does
+        if self.fg_mask is None or self.frame_counter % self.update_every == 0:
+            if self.use_cuda:
+                self.fg_mask = self._foreground_mask_cuda(frame)
+            else:
+                self.fg_mask = self._foreground_mask(frame)
+                
+            # Areas are measured in the downscaled mask, boxes are scaled back to frame coordinates
+            scale = frame.shape[1] / self.fg_mask.shape[1]
+            bboxes = component_boxes(self.fg_mask, self.min_contour_area / (scale * scale)) * scale
+            self.motion_boxes = make_detections(
+                bboxes, np.ones(len(bboxes)), np.full(len(bboxes), MOTION_TYPE)
+            )
+        self.frame_counter += 1
+                
+        return self.motion_boxes
+        
+    def _small_size(self, frame):
+        h, w = frame.shape[:2]
+        if w <= self.work_width:
+            return (w, h)
+        return (self.work_width, max(1, round(h * self.work_width / w)))
         
-        # Remove shadows (gray pixels)
+    def _foreground_mask(self, frame):
+        """Binary foreground mask of the downscaled frame"""
+        size = self._small_size(frame)
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA) if size != frame.shape[1::-1] else frame
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        
+        # Idle scene: nothing was moving and no pixel has changed by more than the threshold
+        # since the background model last ran, so its mask can't have changed either
+        if self._is_idle(gray):
+            return self.fg_mask
+        self.reference_gray = gray
+        
+        fg_mask = self.background_subtractor.apply(gray)
         _, thresh = cv2.threshold(fg_mask, 128, 255, cv2.THRESH_BINARY)
+        return thresh
         
-        # Find contours
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        motion_regions = []
-        for contour in contours:
-            if cv2.contourArea(contour) > self.min_contour_area:
-                x, y, w, h = cv2.boundingRect(contour)
-                motion_regions.append({
-                    "bbox": [x, y, x+w, y+h],
-                    "confidence": 1.0,
-                    "label": "motion"
-                })
-                
-        return motion_regions
+    def _is_idle(self, gray):
+        if (self.reference_gray is None or self.reference_gray.shape != gray.shape
+                or self.motion_boxes is None or len(self.motion_boxes["bboxes"]) > 0):
+            return False
+        return cv2.absdiff(gray, self.reference_gray).max() <= self.idle_threshold
+        
+    def _foreground_mask_cuda(self, frame):
+        """Same as _foreground_mask with one upload per frame and every step queued on one CUDA stream"""
+        self.gpu_frame.upload(frame, self.stream)
+        small = cv2.cuda.resize(self.gpu_frame, self._small_size(frame),
+                                interpolation=cv2.INTER_AREA, stream=self.stream)
+        gray = cv2.cuda.cvtColor(small, cv2.COLOR_BGR2GRAY, stream=self.stream)
+        fg_mask = self.background_subtractor.apply(gray, -1, self.stream)
+        _, thresh = cv2.cuda.threshold(fg_mask, 128, 255, cv2.THRESH_BINARY, stream=self.stream)
+        mask = thresh.download(self.stream)
+        self.stream.waitForCompletion()
+        return mask
         
 class YOLODetector:
-    def __init__(self, model_path, confidence=0.5):
+    INPUT_SIZE = 640
+    MAX_BATCH = 16
+    
+    def __init__(self, model_path, confidence=0.5, num_threads=None):
+        # torch is imported lazily so the server can boot without it (e.g. behind DummyModel)
+        import torch
+        
         self.confidence = confidence
+        self.num_threads = num_threads
+        self.iou_threshold = 0.45
         
         # Check if model exists
         if not os.path.exists(model_path):
@@ -88,34 +399,469 @@ class YOLODetector:
                 self.model = DummyModel()
                 
         # Set confidence threshold
-        self.model.conf = 0.3  # Lower confidence for broader detection
+        self.model.conf = confidence  # Same threshold as the TensorRT backend
         # Set to only detect people (class 0 in COCO dataset)
         self.model.classes = [0]  # Detect only people
         
-    def detect(self, frame):
-        try:
-            # Convert frame to RGB
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        # Label detections with the loaded model's own class names
+        names = getattr(self.model, "names", None)
+        if names:
+            set_label_names(names)
+        
+        if not isinstance(self.model, DummyModel):
+            self._prepare_inference()
             
-            # Run inference
-            results = self.model(rgb_frame)
+    def _prepare_inference(self):
+        """Move the model to its device in channels-last layout and allocate persistent input buffers"""
+        import torch
+        
+        # Size torch's intra-op pool to the detection worker's CPUs when they are pinned
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        use_half = self.device.type == "cuda"
+        self.input_dtype = torch.float16 if use_half else torch.float32
+        
+        # Convert the weights once so no conv has to permute its input per call
+        self.model = self.model.to(self.device).to(memory_format=torch.channels_last)
+        if use_half:
+            self.model = self.model.half()
+            
+        # AutoShape only adds per-call dispatch for tensor inputs; call the network underneath
+        self.raw_model = getattr(self.model, "model", self.model)
+        
+        # Reverse the input channels of the first conv so the model takes BGR directly and
+        # frames never need a BGR -> RGB pass. Pre-v6 checkpoints start with a Focus layer,
+        # whose conv sees 4 space-to-depth slices of 3 color channels each
+        first_conv = next(m for m in self.model.modules() if isinstance(m, torch.nn.Conv2d))
+        weight = first_conv.weight
+        self.swap_channels = False
+        with torch.no_grad():
+            if first_conv.in_channels == 3:
+                weight.copy_(weight.flip(1))
+            elif first_conv.in_channels == 12:
+                o, _, kh, kw = weight.shape
+                weight.copy_(weight.view(o, 4, 3, kh, kw).flip(2).reshape(weight.shape))
+            else:
+                logger.warning(f"First conv takes {first_conv.in_channels} channels, "
+                               f"swapping BGR -> RGB per batch instead of in the weights")
+                self.swap_channels = True
+                
+        # Letterboxed BGR frames cross to the device as NHWC uint8 through a pinned buffer. NHWC is
+        # the memory order of the channels-last input, so filling it on the device is a plain
+        # elementwise cast + scale. No per-call allocation
+        shape = (self.MAX_BATCH, self.INPUT_SIZE, self.INPUT_SIZE, 3)
+        self.host_input = torch.empty(shape, dtype=torch.uint8, pin_memory=use_half)
+        if use_half:
+            self.device_staging = torch.empty(shape, dtype=torch.uint8, device=self.device)
+        else:
+            self.device_staging = self.host_input
+        self.device_input = torch.empty((self.MAX_BATCH, 3, self.INPUT_SIZE, self.INPUT_SIZE),
+                                        dtype=self.input_dtype, device=self.device,
+                                        memory_format=torch.channels_last)
+        
+    def preprocess(self, frame):
+        if isinstance(self.model, DummyModel):
+            return self.model.preprocess(frame)
+        # Layout conversion and normalization happen on the device in _infer
+        return preprocess(frame, self.INPUT_SIZE, raw=True)
+        
+    def detect(self, frame):
+        return self.detect_batch([frame])[0]
+        
+    def detect_batch(self, frames):
+        """Run a forward pass over a list of BGR frames, one detection set per frame"""
+        return self.detect_prepared([self.preprocess(frame) for frame in frames])
+        
+    def detect_prepared(self, prepared):
+        """Run a forward pass over frames already passed through preprocess()"""
+        if isinstance(self.model, DummyModel):
+            return self.model.detect_prepared(prepared)
             
-            # Process results
-            detections = []
-            for *box, conf, cls in results.xyxy[0].cpu().numpy():
-                x1, y1, x2, y2 = map(int, box)
-                class_id = int(cls)
-                class_name = self.model.names[class_id] if class_id < len(self.model.names) else "unknown"
-                detections.append({
-                    "bbox": [x1, y1, x2, y2],
-                    "confidence": float(conf),
-                    "label": class_name
-                })
+        batch_detections = []
+        for start in range(0, len(prepared), self.MAX_BATCH):
+            batch_detections.extend(self._infer(prepared[start:start + self.MAX_BATCH]))
+        return batch_detections
+        
+    def _infer(self, prepared):
+        import torch
+        
+        try:
+            n = len(prepared)
+            host_input = self.host_input[:n]
+            for i, p in enumerate(prepared):
+                host_input[i].copy_(torch.from_numpy(p["tensor"]))
+            staged = self.device_staging[:n]
+            if self.device_staging is not self.host_input:
+                staged.copy_(host_input, non_blocking=True)
+            if self.swap_channels:
+                staged = staged.flip(-1)
+            x = self.device_input[:n]
+            x.permute(0, 2, 3, 1).copy_(staged)
+            x.mul_(1 / 255.0)
                 
-            return detections
+            # The raw network skips the hub wrapper's preprocessing and NMS; inference_mode
+            # also skips the view / version-counter tracking no_grad still does
+            with torch.inference_mode():
+                pred = self.raw_model(x)
+            if isinstance(pred, (list, tuple)):
+                pred = pred[0]
+            preds = pred.float().cpu().numpy()
+            
+            return [
+                decode_yolo_output(pred, p["shape"], p["ratio"], p["pad"],
+                                   conf_thres=self.confidence,
+                                   iou_thres=self.iou_threshold,
+                                   classes=self.model.classes)
+                for pred, p in zip(preds, prepared)
+            ]
         except Exception as e:
             logger.error(f"Error in detection: {str(e)}")
-            return []
+            return [make_detections() for _ in prepared]
+
+class TRTYOLODetector:
+    """YOLOv5 detector running a serialized TensorRT FP16 engine instead of PyTorch"""
+
+    INPUT_SIZE = 640
+    MAX_BATCH = 16
+
+    def __init__(self, model_path, confidence=0.5, engine_path="models/yolov5s.engine",
+                 int8_engine_path="models/yolov5s.int8.engine", calibration_videos=None):
+        if not TRT_AVAILABLE:
+            raise RuntimeError("TensorRT / cuda-python is not installed")
+
+        self.confidence = confidence
+        self.iou_threshold = 0.45
+        self.classes = [0]  # Detect only people
+        self.trt_logger = trt.Logger(trt.Logger.WARNING)
+
+        self.runtime = trt.Runtime(self.trt_logger)
+
+        # Build the engine once, later starts just deserialize it. An INT8 engine is
+        # preferred when it loads, and is (re)built only when calibration videos are given;
+        # without them, or if calibration fails, the FP16 engine is used
+        onnx_path = str(Path(model_path).with_suffix(".onnx"))
+        self.engine = None
+        if int8_engine_path:
+            self.engine = self._load_engine(int8_engine_path)
+            if self.engine is None and calibration_videos:
+                self.engine = self._build_int8_engine(model_path, onnx_path, int8_engine_path,
+                                                      calibration_videos)
+            if self.engine is not None:
+                engine_path = int8_engine_path
+        if self.engine is None:
+            self.engine = self._load_engine(engine_path)
+        if self.engine is None:
+            self._export_onnx(model_path, onnx_path)
+            self._build_engine(onnx_path, engine_path)
+            self.engine = self._load_engine(engine_path)
+            if self.engine is None:
+                raise RuntimeError(f"Failed to load TensorRT engine {engine_path}")
+
+        # Two pipelines (execution context + CUDA stream + pinned/device buffers) let one
+        # sub-batch's copies overlap the other's inference. Each needs its own optimization
+        # profile, so engines built with a single profile fall back to one pipeline
+        self.input_shape = (self.MAX_BATCH, 3, self.INPUT_SIZE, self.INPUT_SIZE)
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        outputs = [name for name in names
+                   if self.engine.get_tensor_mode(name) == trt.TensorIOMode.OUTPUT]
+        if len(outputs) != 1:
+            raise RuntimeError(f"Expected one output tensor in {engine_path}, found {outputs}")
+        self.input_name = "images"
+        self.output_name = outputs[0]
+        self.output_shape = (self.MAX_BATCH,) + tuple(self.engine.get_tensor_shape(self.output_name))[1:]
+        num_profiles = self.engine.num_optimization_profiles
+        self.pipelines = [self._create_pipeline(i) for i in range(min(2, num_profiles))]
+        self.lock = threading.Lock()
+
+        logger.info(f"Loaded TensorRT engine {engine_path} ({len(self.pipelines)} pipelines)")
+
+    def _create_pipeline(self, profile):
+        stream = _cuda_call(cudart.cudaStreamCreate())
+        context = self.engine.create_execution_context()
+        if profile > 0:
+            context.set_optimization_profile_async(profile, int(stream))
+
+        # Pinned host + device buffers sized for the largest batch the engine accepts
+        h_input, h_input_ptr = self._alloc_host(self.input_shape, np.float16)
+        h_output, h_output_ptr = self._alloc_host(self.output_shape, np.float32)
+        d_input = _cuda_call(cudart.cudaMalloc(h_input.nbytes))
+        d_output = _cuda_call(cudart.cudaMalloc(h_output.nbytes))
+
+        context.set_tensor_address(self.input_name, int(d_input))
+        context.set_tensor_address(self.output_name, int(d_output))
+
+        return {
+            "context": context, "stream": stream,
+            "h_input": h_input, "h_input_ptr": h_input_ptr, "d_input": d_input,
+            "h_output": h_output, "h_output_ptr": h_output_ptr, "d_output": d_output
+        }
+
+    def _build_int8_engine(self, model_path, onnx_path, engine_path, calibration_videos):
+        """
+        Calibrate and build the INT8 engine
+        Returns: the engine, or None if there aren't enough calibration frames or the build
+        fails, in which case the FP16 engine is used instead
+        """
+        try:
+            cache_path = str(Path(engine_path).with_name(Path(model_path).stem + "-int8-calib.cache"))
+            calibrator = YOLOInt8Calibrator(
+                calibration_videos, cache_path, input_size=self.INPUT_SIZE
+            )
+            # A saved calibration cache stands in for the frames
+            if len(calibrator.samples) < calibrator.batch_size and not os.path.exists(cache_path):
+                logger.warning(f"Only {len(calibrator.samples)} calibration frames found, "
+                               f"need {calibrator.batch_size}; using the FP16 engine")
+                return None
+            self._export_onnx(model_path, onnx_path)
+            self._build_engine(onnx_path, engine_path, calibrator)
+            return self._load_engine(engine_path)
+        except Exception as e:
+            logger.error(f"Failed to build INT8 engine {engine_path}, using the FP16 engine: {str(e)}")
+            return None
+
+    def _load_engine(self, engine_path):
+        """
+        Deserialize a saved engine
+        Returns: the engine, or None if it is missing or was built for another TensorRT version / GPU
+        """
+        if not os.path.exists(engine_path):
+            return None
+        with open(engine_path, "rb") as f:
+            engine = self.runtime.deserialize_cuda_engine(f.read())
+        if engine is None:
+            logger.warning(f"{engine_path} can't be loaded by this TensorRT version / GPU")
+        return engine
+
+    @staticmethod
+    def _alloc_host(shape, dtype):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        ptr = _cuda_call(cudart.cudaMallocHost(nbytes))
+        raw = (ctypes.c_byte * nbytes).from_address(int(ptr))
+        return np.frombuffer(raw, dtype=dtype).reshape(shape), ptr
+
+    def _export_onnx(self, model_path, onnx_path):
+        if os.path.exists(onnx_path):
+            return
+        logger.info(f"Exporting {model_path} to ONNX at {onnx_path}...")
+        sys.path.insert(0, os.getcwd())
+        try:
+            import torch.hub
+            torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
+            # autoshape=False gives the raw detection model, which is what we want to trace
+            if os.path.exists(model_path):
+                model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path,
+                                       autoshape=False, verbose=False)
+            else:
+                model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True,
+                                       autoshape=False, verbose=False)
+        finally:
+            sys.path.pop(0)
+
+        # Same switches as yolov5's export.py: the Detect head then returns only the
+        # concatenated predictions instead of (predictions, feature maps)
+        model.eval()
+        for m in model.modules():
+            if type(m).__name__ in ("Detect", "Segment"):
+                m.inplace = False
+                m.dynamic = True
+                m.export = True
+        dummy = torch.zeros(1, 3, self.INPUT_SIZE, self.INPUT_SIZE)
+        torch.onnx.export(
+            model, dummy, onnx_path,
+            opset_version=13,
+            input_names=["images"],
+            output_names=["output"],
+            dynamic_axes={"images": {0: "N"}, "output": {0: "N"}}
+        )
+
+    def _build_engine(self, onnx_path, engine_path, int8_calibrator=None):
+        precision = "INT8" if int8_calibrator else "FP16"
+        logger.info(f"Building TensorRT {precision} engine {engine_path}, this can take a few minutes...")
+        builder = trt.Builder(self.trt_logger)
+        explicit_batch = 1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
+        network = builder.create_network(explicit_batch)
+        parser = trt.OnnxParser(network, self.trt_logger)
+
+        with open(onnx_path, "rb") as f:
+            if not parser.parse(f.read()):
+                errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+                raise RuntimeError(f"Failed to parse {onnx_path}: {errors}")
+
+        # Feed FP16 straight in so the host buffer is half the size
+        network.get_input(0).dtype = trt.float16
+
+        config = builder.create_builder_config()
+        config.set_flag(trt.BuilderFlag.FP16)
+        if hasattr(config, "set_memory_pool_limit"):
+            config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, 1 << 30)
+        else:
+            config.max_workspace_size = 1 << 30
+
+        # One identical profile per inference pipeline
+        shape = (3, self.INPUT_SIZE, self.INPUT_SIZE)
+        for _ in range(2):
+            profile = builder.create_optimization_profile()
+            profile.set_shape("images", (1,) + shape, (1,) + shape, (self.MAX_BATCH,) + shape)
+            config.add_optimization_profile(profile)
+
+        # FP16 stays enabled so layers without INT8 kernels fall back to half precision
+        if int8_calibrator:
+            config.set_flag(trt.BuilderFlag.INT8)
+            config.int8_calibrator = int8_calibrator
+            calib_shape = (int8_calibrator.get_batch_size(),) + shape
+            calib_profile = builder.create_optimization_profile()
+            calib_profile.set_shape("images", calib_shape, calib_shape, calib_shape)
+            config.set_calibration_profile(calib_profile)
+
+        serialized = builder.build_serialized_network(network, config)
+        if serialized is None:
+            raise RuntimeError("TensorRT engine build failed")
+        with open(engine_path, "wb") as f:
+            f.write(serialized)
+
+    def preprocess(self, frame):
+        return preprocess(frame, self.INPUT_SIZE)
+
+    def detect(self, frame):
+        return self.detect_batch([frame])[0]
+
+    def detect_batch(self, frames):
+        """Run the engine over a list of BGR frames"""
+        return self.detect_prepared([self.preprocess(frame) for frame in frames])
+
+    def detect_prepared(self, prepared):
+        """Run the engine over frames already passed through preprocess(), MAX_BATCH per launch"""
+        batch_detections = []
+        for start in range(0, len(prepared), self.MAX_BATCH):
+            batch_detections.extend(self._infer(prepared[start:start + self.MAX_BATCH]))
+        return batch_detections
+
+    def _infer(self, prepared):
+        """
+        Split the frames into one sub-batch per pipeline and software-pipeline them: while
+        sub-batch k runs on its stream, sub-batch k+1 is enqueued on the other stream,
+        then k is synchronized and decoded while k+1 runs
+        """
+        try:
+            chunk_size = -(-len(prepared) // len(self.pipelines))
+            chunks = [prepared[i:i + chunk_size] for i in range(0, len(prepared), chunk_size)]
+
+            batch_detections = []
+            with self.lock:
+                pending = None
+                for k, chunk in enumerate(chunks):
+                    pipeline = self.pipelines[k % len(self.pipelines)]
+                    self._enqueue(pipeline, chunk)
+                    if pending:
+                        batch_detections.extend(self._collect(*pending))
+                    pending = (pipeline, chunk)
+                batch_detections.extend(self._collect(*pending))
+            return batch_detections
+        except Exception as e:
+            logger.error(f"Error in TensorRT detection: {str(e)}")
+            return [make_detections() for _ in prepared]
+
+    def _enqueue(self, pipeline, prepared):
+        """Copy into the pipeline's pinned buffer and queue H2D, inference and D2H on its stream"""
+        n = len(prepared)
+        for i, p in enumerate(prepared):
+            pipeline["h_input"][i] = p["tensor"]
+
+        context, stream = pipeline["context"], pipeline["stream"]
+        context.set_input_shape(self.input_name, (n,) + self.input_shape[1:])
+        _cuda_call(cudart.cudaMemcpyAsync(
+            pipeline["d_input"], pipeline["h_input_ptr"], pipeline["h_input"][:n].nbytes,
+            cudart.cudaMemcpyKind.cudaMemcpyHostToDevice, stream))
+        if not context.execute_async_v3(int(stream)):
+            raise RuntimeError("TensorRT failed to enqueue inference")
+        _cuda_call(cudart.cudaMemcpyAsync(
+            pipeline["h_output_ptr"], pipeline["d_output"], pipeline["h_output"][:n].nbytes,
+            cudart.cudaMemcpyKind.cudaMemcpyDeviceToHost, stream))
+
+    def _collect(self, pipeline, prepared):
+        """Wait for the pipeline's stream and decode its output"""
+        _cuda_call(cudart.cudaStreamSynchronize(pipeline["stream"]))
+        preds = pipeline["h_output"][:len(prepared)]
+        return [
+            decode_yolo_output(pred, p["shape"], p["ratio"], p["pad"],
+                               conf_thres=self.confidence,
+                               iou_thres=self.iou_threshold,
+                               classes=self.classes)
+            for pred, p in zip(preds, prepared)
+        ]
+
+if trt is not None:
+    class YOLOInt8Calibrator(trt.IInt8EntropyCalibrator2):
+        """
+        Feeds frames sampled from the local videos to TensorRT's INT8 calibration,
+        preprocessed exactly like TRTYOLODetector does at inference time
+        """
+
+        def __init__(self, video_paths, cache_path, num_frames=500, batch_size=8, input_size=640):
+            trt.IInt8EntropyCalibrator2.__init__(self)
+            self.cache_path = cache_path
+            self.batch_size = batch_size
+            self.input_size = input_size
+            self.samples = self._sample_frames(video_paths or [], num_frames)
+            self.position = 0
+
+            self.h_batch = np.empty((batch_size, 3, input_size, input_size), dtype=np.float16)
+            self.d_batch = _cuda_call(cudart.cudaMalloc(self.h_batch.nbytes))
+
+        @staticmethod
+        def _sample_frames(video_paths, num_frames):
+            """Pick num_frames random (path, frame index) pairs spread across the videos"""
+            samples = []
+            rng = np.random.default_rng(0)
+            per_video = max(1, num_frames // max(1, len(video_paths)))
+            for path in video_paths:
+                cap = cv2.VideoCapture(path)
+                total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                cap.release()
+                if total <= 0:
+                    continue
+                indices = rng.choice(total, size=min(per_video, total), replace=False)
+                samples.extend((path, int(i)) for i in sorted(indices))
+            return samples[:num_frames]
+
+        def get_batch_size(self):
+            return self.batch_size
+
+        def get_batch(self, names):
+            if self.position + self.batch_size > len(self.samples):
+                return None
+
+            cap, cap_path = None, None
+            for i, (path, index) in enumerate(self.samples[self.position:self.position + self.batch_size]):
+                if path != cap_path:
+                    if cap:
+                        cap.release()
+                    cap, cap_path = cv2.VideoCapture(path), path
+                cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                success, frame = cap.read()
+                if not success:
+                    frame = np.zeros((self.input_size, self.input_size, 3), dtype=np.uint8)
+                self.h_batch[i] = preprocess(frame, self.input_size)["tensor"]
+            if cap:
+                cap.release()
+            self.position += self.batch_size
+
+            _cuda_call(cudart.cudaMemcpy(
+                self.d_batch, self.h_batch.ctypes.data, self.h_batch.nbytes,
+                cudart.cudaMemcpyKind.cudaMemcpyHostToDevice))
+            return [int(self.d_batch)]
+
+        def read_calibration_cache(self):
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, "rb") as f:
+                    return f.read()
+            return None
+
+        def write_calibration_cache(self, cache):
+            with open(self.cache_path, "wb") as f:
+                f.write(cache)
 
 # Dummy model class for graceful degradation
 class DummyModel:
@@ -126,28 +872,196 @@ class DummyModel:
         self.classes = [0]
         logger.warning("Using dummy model - no detections will be made!")
         
-    def __call__(self, frame):
-        # Return a dummy result structure compatible with the expected format
-        class DummyResults:
-            def __init__(self):
-                self.xyxy = [torch.zeros((0, 6))]  # Empty tensor with shape (0, 6)
+    def preprocess(self, frame):
+        # Nothing will look at the pixels, so skip the letterbox work
+        return {"shape": frame.shape}
         
-        return DummyResults()
+    def detect(self, frame):
+        return make_detections()
+        
+    def detect_batch(self, frames):
+        return [make_detections() for _ in frames]
+        
+    def detect_prepared(self, prepared):
+        return [make_detections() for _ in prepared]
+
+class BatchedDetectorWorker:
+    """
+    Runs object detection for every stream from a single thread. Streams submit
+    frames to a shared request queue; as soon as a batch finishes, the next one is
+    formed from whatever requests are already waiting (continuous batching), so
+    there is no fixed batch size to wait for and slow streams never hold back fast ones.
+    A short max_wait window after the first request lets streams whose frames arrive
+    a few milliseconds apart share one forward pass
+    """
+    
+    def __init__(self, object_detector, max_batch=16, max_wait=0.01, cpus=None):
+        self.object_detector = object_detector
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cpus = cpus
+        self.inference_requests = queue.Queue()
+        self.running = False
+        self.thread = None
+        
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info(f"Batched detector started (max batch {self.max_batch}, "
+                    f"max wait {self.max_wait * 1000:.0f} ms)")
+        
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+            
+    def submit(self, stream_id, frame, is_alive=lambda: True):
+        """
+        Preprocess a frame on the calling stream's thread, queue it for detection and block
+        until its batch has run. Preprocessing here keeps it off the single worker thread,
+        so the worker only copies ready tensors into the batch
+        Returns: Detection set, or None if is_alive() went False while waiting
+        """
+        prepared = self.object_detector.preprocess(frame)
+        event = threading.Event()
+        result_holder = {}
+        self.inference_requests.put((stream_id, prepared, event, result_holder))
+        while is_alive():
+            if event.wait(timeout=0.5):
+                return result_holder.get("detections", make_detections())
+        return None
+            
+    def _run(self):
+        # Keep the detector on one set of cores (e.g. a single socket) so its buffers stay local
+        if self.cpus and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError as e:
+                logger.warning(f"Could not pin detector thread to CPUs {self.cpus}: {str(e)}")
+                
+        while self.running:
+            try:
+                first = self.inference_requests.get(timeout=0.5)
+            except queue.Empty:
+                continue
+                
+            # Take whatever else is queued or arrives within max_wait of the first request
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self.inference_requests.get(timeout=remaining))
+                    else:
+                        batch.append(self.inference_requests.get_nowait())
+                except queue.Empty:
+                    break
+                    
+            try:
+                results = self.object_detector.detect_prepared([prepared for _, prepared, _, _ in batch])
+            except Exception as e:
+                logger.error(f"Error in batched detection: {str(e)}")
+                results = [make_detections() for _ in batch]
+                
+            # Hand results back and wake every waiting stream
+            for (_, _, event, result_holder), detections in zip(batch, results):
+                result_holder["detections"] = detections
+                event.set()
+
+# Seconds after the last snapshot / video feed request during which frames keep being annotated
+VIEWER_IDLE_TIMEOUT = 5.0
+
+class FrameTripleBuffer:
+    """
+    Three frame slots shared by the capture thread and the detection thread. The
+    producer decodes into its back slot and swaps it with the ready slot; the consumer
+    swaps the ready slot into its front slot. Frames are never copied, and neither
+    side ever touches a slot the other one is using. Each frame carries a "due" flag
+    saying whether the detectors should run on it
+    """
+    
+    def __init__(self):
+        self.slots = [None, None, None]
+        self.due = [False, False, False]
+        self.back, self.ready, self.front = 0, 1, 2
+        self.fresh = False
+        self.cond = threading.Condition()
+        
+    def back_buffer(self):
+        """Slot the producer should decode into next (None until first used)"""
+        return self.slots[self.back]
+        
+    def publish(self, frame, due=True):
+        """Make the frame just written by the producer the ready frame"""
+        with self.cond:
+            # cv2 reallocates when the slot is missing or the resolution changed
+            self.slots[self.back] = frame
+            # A due frame replaced before it was consumed passes its turn on to the newer one
+            self.due[self.back] = due or (self.fresh and self.due[self.ready])
+            self.back, self.ready = self.ready, self.back
+            self.fresh = True
+            self.cond.notify()
+            
+    def acquire(self, timeout=None, is_alive=lambda: True):
+        """
+        Swap in the newest frame for the consumer, sleeping until one is published
+        Returns: (frame, due), or (None, False) on timeout or once is_alive() goes False
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.fresh or not is_alive(), timeout)
+            if not self.fresh:
+                return None, False
+            self.front, self.ready = self.ready, self.front
+            self.fresh = False
+            return self.slots[self.front], self.due[self.front]
+            
+    def wake(self):
+        """Wake a waiting consumer so it can re-check is_alive()"""
+        with self.cond:
+            self.cond.notify_all()
+            
+    def peek(self):
+        """Copy of the newest published frame, for readers outside the pipeline"""
+        with self.cond:
+            frame = self.slots[self.ready] if self.fresh else self.slots[self.front]
+            return None if frame is None else frame.copy()
 
 class StreamProcessor:
-    def __init__(self, stream_id, url, config, object_detector):
+    def __init__(self, stream_id, url, config, detection_worker):
         self.stream_id = stream_id
         self.url = url
         self.config = config
         self.cap = None
         self.running = False
         self.thread = None
-        self.latest_frame = None
-        # Increased queue sizes for scalability
-        self.frame_queue = Queue(maxsize=20)
-        self.result_queue = Queue(maxsize=20)
+        self.detection_thread = None
+        self.annotate_thread = None
+        # Decoded frames are handed to the detection thread without copying
+        self.frames = FrameTripleBuffer()
+        # Only the newest result is ever read, so keep a single slot instead of a queue
+        self._latest_result = None
+        self._result_lock = threading.Lock()
+        # Frames to annotate go to the annotate thread through a one-slot queue, copied into
+        # two alternating buffers: the one not last queued is never in use by that thread
+        self.annotate_queue = queue.Queue(maxsize=1)
+        self.annotate_buffers = [None, None]
+        self.annotate_index = 0
+        # Each annotated frame is JPEG-encoded once and shared by every HTTP viewer
+        self.latest_jpeg: bytes = b''
+        self.jpeg_seq = 0
+        self.jpeg_cond = threading.Condition()
+        self.jpeg_listeners = []  # Callbacks run on every publish, for feeds that can't block on jpeg_cond
+        # Frames are only annotated while a video feed has asked for them recently
+        self.last_feed_ts = 0
         self.fps = 0
         self.is_local_file = os.path.isfile(url)
+        # GStreamer decoders that failed to open this source, not retried on reconnects
+        self.failed_decoders = set()
         self.video_name = Path(url).name if self.is_local_file else url
         self.last_frame_time = 0
         self.original_fps = 0
@@ -155,20 +1069,23 @@ class StreamProcessor:
         self.total_frames = 0
         self.motion_detector = MotionDetector(
             threshold=config["motion"]["threshold"],
-            min_contour_area=config["motion"]["contour_area"]
+            min_contour_area=config["motion"]["contour_area"],
+            use_cuda=config["motion"].get("use_cuda", True),
+            idle_threshold=config["motion"].get("idle_threshold", 15)
         )
-        self.object_detector = object_detector
+        # Object detection is done by the shared BatchedDetectorWorker
+        self.detection_worker = detection_worker
         self.start_time = None  # Ensure the attribute is initialized
-        self.detection_frame_counter = 0
-        self.last_object_detections = []
-        self.last_motion_detections = []
+        self.last_object_detections = make_detections()
+        self.last_motion_detections = make_detections()
+        self.last_yolo_ts = 0
         
     def start(self):
         if self.running:
             return
             
         self.running = True
-        self.cap = cv2.VideoCapture(self.url)
+        self.cap = self._open_capture()
         if not self.cap.isOpened():
             logger.error(f"Failed to open stream: {self.url}")
             self.running = False
@@ -188,18 +1105,101 @@ class StreamProcessor:
         self.detection_thread.daemon = True
         self.detection_thread.start()
         
+        # Start the annotate thread
+        self.annotate_thread = threading.Thread(target=self._process_annotation)
+        self.annotate_thread.daemon = True
+        self.annotate_thread.start()
+        
         if self.is_local_file:
             self.start_time = time.time()  # For local video pacing
             
         logger.info(f"Stream {self.stream_id} started: {self.video_name}")
         return True
         
+    # Hardware H.264 decoders to try, in order: NVDEC through the Jetson / DeepStream
+    # plugin, NVDEC through gst-plugins-bad, then VA-API (Intel / AMD)
+    HW_DECODERS = [
+        ("NVDEC", "nvv4l2decoder ! nvvideoconvert ! video/x-raw,format=BGRx"),
+        ("NVDEC", "nvh264dec"),
+        ("VA-API", "vah264dec"),
+        ("VA-API", "vaapih264dec"),
+    ]
+    
+    def _gstreamer_pipelines(self):
+        """
+        (decoder name, decoder, pipeline) for each GPU decoder not yet known to fail on this
+        source, empty if the source isn't supported
+        """
+        # Quoted so paths with spaces or URLs with "!" survive gst-launch parsing
+        location = '"' + self.url.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        if self.is_local_file:
+            demuxers = {".mp4": "qtdemux", ".mov": "qtdemux", ".mkv": "matroskademux", ".avi": "avidemux"}
+            demuxer = demuxers.get(Path(self.url).suffix.lower())
+            if demuxer is None:
+                return []
+            source = f"filesrc location={location} ! {demuxer}"
+            # Local files are paced by the capture thread, so block instead of dropping frames
+            sink = "appsink sync=false"
+        elif self.url.startswith("rtsp://"):
+            # No jitter buffer latency: frames are handed over as soon as they arrive
+            source = f"rtspsrc location={location} latency=0 ! rtph264depay"
+            sink = "appsink drop=1 max-buffers=2"
+        else:
+            return []
+            
+        return [
+            (name, decoder,
+             f"{source} ! h264parse ! {decoder} ! videoconvert ! video/x-raw,format=BGR ! {sink}")
+            for name, decoder in self.HW_DECODERS
+            if decoder not in self.failed_decoders
+        ]
+                
+    def _open_capture(self):
+        """Open the stream, preferring hardware decoding and falling back to the default backend"""
+        if self.config.get("capture", {}).get("hw_decode"):
+            for name, decoder, pipeline in self._gstreamer_pipelines():
+                cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+                if cap.isOpened():
+                    logger.info(f"Stream {self.stream_id} using {name} hardware decoding")
+                    return cap
+                cap.release()
+                self.failed_decoders.add(decoder)
+                
+        if self.is_local_file:
+            return cv2.VideoCapture(self.url)
+            
+        # Network streams and cameras: keep a single buffered frame so reads return the
+        # newest frame instead of working through a backlog of stale ones
+        if "://" in self.url:
+            cap = cv2.VideoCapture(self.url, cv2.CAP_FFMPEG)
+        else:
+            cap = cv2.VideoCapture(self.url)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+        
     def stop(self):
         self.running = False
+        self.frames.wake()
+        # Wake the annotate thread with a None sentinel, replacing any frame still queued
+        try:
+            self.annotate_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.annotate_queue.put_nowait(None)
+        except queue.Full:
+            pass
+        with self.jpeg_cond:
+            self.jpeg_cond.notify_all()  # Release any waiting video feeds
+            listeners = list(self.jpeg_listeners)
+        for listener in listeners:
+            listener()
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=1.0)
         if self.detection_thread and self.detection_thread.is_alive():
             self.detection_thread.join(timeout=1.0)
+        if self.annotate_thread and self.annotate_thread.is_alive():
+            self.annotate_thread.join(timeout=1.0)
         if self.cap:
             self.cap.release()
         logger.info(f"Stream {self.stream_id} stopped")
@@ -216,7 +1216,13 @@ class StreamProcessor:
                     if elapsed < target_time:
                         time.sleep(target_time - elapsed)
                 
-                success, frame = self.cap.read()
+                # Without viewers only the frames the detectors will see are decoded to BGR;
+                # the rest are just grabbed, which skips the color conversion and copy
+                due = self.frame_count % self._detection_interval() == 0
+                if due or self._has_viewers():
+                    success, frame = self.cap.read(self.frames.back_buffer())
+                else:
+                    success, frame = self.cap.grab(), None
                 
                 if not success:
                     if not self.is_local_file:
@@ -224,11 +1230,14 @@ class StreamProcessor:
                         # Try to reconnect for network streams
                         self.cap.release()
                         time.sleep(1)
-                        self.cap = cv2.VideoCapture(self.url)
+                        self.cap = self._open_capture()
                         continue
                     else:
                         logger.info(f"End of video {self.url}, looping back")
-                        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        if not self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                            # Not every backend can seek (e.g. GStreamer), so reopen instead
+                            self.cap.release()
+                            self.cap = self._open_capture()
                         self.frame_count = 0
                         self.start_time = time.time()  # Reset start time for new playback
                         continue
@@ -243,12 +1252,9 @@ class StreamProcessor:
                     frame_count = 0
                     last_time = current_time
                 
-                # Store latest frame
-                self.latest_frame = frame.copy()
-                
-                # Add to processing queue, dropping frames if queue is full
-                if not self.frame_queue.full():
-                    self.frame_queue.put(frame)
+                # Hand the frame to the detection thread, replacing any unconsumed one
+                if frame is not None:
+                    self.frames.publish(frame, due)
                     
             except Exception as e:
                 logger.error(f"Error processing stream {self.stream_id}: {str(e)}")
@@ -257,81 +1263,190 @@ class StreamProcessor:
     def _process_detection(self):
         while self.running:
             try:
-                if self.frame_queue.empty():
-                    time.sleep(0.01)
+                # Sleeps until the capture thread publishes a frame; stop() wakes it
+                frame, due = self.frames.acquire(timeout=1.0, is_alive=lambda: self.running)
+                if frame is None:
                     continue
 
-                frame = self.frame_queue.get()
-                self.detection_frame_counter += 1
-
                 results = {"timestamp": time.time()}
 
-                # Only run detectors every N frames to save CPU
-                process_this_frame = (
-                    self.detection_frame_counter 
-                    % self.config["detection"]["process_every_n_frames"]
-                ) == 0
-
-                if process_this_frame:
+                # Only run detectors on the frames the capture thread marked as due
+                if due:
                     if self.config["motion"]["enabled"]:
                         self.last_motion_detections = self.motion_detector.detect(frame)
 
-                    if self.config["detection"]["enabled"]:
-                        self.last_object_detections = self.object_detector.detect(frame)
-
-                results["motion"] = self.last_motion_detections
-                results["detections"] = self.last_object_detections
+                    if self.config["detection"]["enabled"] and not self._can_skip_detection():
+                        self.last_object_detections = self._request_detection(frame)
+                        self.last_yolo_ts = time.time()
 
-                # Add annotated frame
-                annotated_frame = self._annotate_frame(frame.copy(), self.last_object_detections, self.last_motion_detections)
-                results["frame"] = annotated_frame
+                results["detections"] = concat_detections(
+                    self.last_object_detections, self.last_motion_detections
+                )
 
                 # Store results
-                if not self.result_queue.full():
-                    self.result_queue.put(results)
-                else:
-                    # Remove oldest result if queue is full
-                    self.result_queue.get()
-                    self.result_queue.put(results)
+                with self._result_lock:
+                    self._latest_result = results
+
+                # Hand the frame to the annotate thread, unless nobody is watching. If it is
+                # still busy with the previous one, this frame is dropped from the feed
+                if self._has_viewers() and not self.annotate_queue.full():
+                    self._queue_annotation(frame, results["detections"])
 
             except Exception as e:
                 logger.error(f"Error in detection for stream {self.stream_id}: {str(e)}")
                 time.sleep(0.1)
                 
-    def _annotate_frame(self, frame, object_detections, motion_detections):
-        # Draw object detections (people)
-        for detection in object_detections:
-            x1, y1, x2, y2 = detection["bbox"]
-            label = detection["label"]
-            color = (0, 255, 0)  # Green for person
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            cv2.putText(frame,
-                        f"{label} {detection['confidence']:.2f}",
-                        (x1, y1 - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.5,
-                        color,
-                        2)
-
-        # Draw motion detections
-        for motion in motion_detections:
-            x1, y1, x2, y2 = motion["bbox"]
-            color = (0, 0, 255)  # Red for motion
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            cv2.putText(frame, "Motion", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+    def _queue_annotation(self, frame, detections):
+        # The frame is a triple buffer slot the capture thread will reuse, so copy it out
+        self.annotate_index ^= 1
+        buffer = self.annotate_buffers[self.annotate_index]
+        if buffer is None or buffer.shape != frame.shape:
+            buffer = self.annotate_buffers[self.annotate_index] = np.empty_like(frame)
+        np.copyto(buffer, frame)
+        self.annotate_queue.put_nowait((buffer, detections))
+        
+    def _process_annotation(self):
+        while self.running:
+            try:
+                item = self.annotate_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if item is None:
+                break  # Stopped
+            frame, detections = item
+            try:
+                # Drawing and encoding here overlaps with the next frame's detection
+                self._annotate_frame(frame, detections)
+                self._publish_jpeg(encode_jpeg(frame, self._jpeg_quality()))
+            except Exception as e:
+                logger.error(f"Error annotating stream {self.stream_id}: {str(e)}")
+                
+    def _jpeg_quality(self):
+        return self.config.get("server", {}).get("jpeg_quality", 80)
+        
+    def _detection_interval(self):
+        """
+        Captured frames per detector run: process_every_n_frames, or enough to hit
+        detection.target_fps when that is set and the source frame rate is known
+        """
+        detection_config = self.config["detection"]
+        target_fps = detection_config.get("target_fps")
+        # Some network sources report nonsense rates (e.g. the RTP clock), don't trust those
+        if target_fps and 0 < self.original_fps <= 240:
+            return max(1, int(round(self.original_fps / target_fps)))
+        return detection_config["process_every_n_frames"]
+        
+    def _has_viewers(self):
+        """True while a video feed was open recently. Snapshots don't count, they render on demand"""
+        return time.time() - self.last_feed_ts < VIEWER_IDLE_TIMEOUT
+        
+    def _can_skip_detection(self):
+        """
+        Motion gate: with no motion in the frame the previous object detections are still
+        valid, so the detector only needs to re-run once they are older than the max age
+        """
+        detection_config = self.config["detection"]
+        return (
+            detection_config.get("motion_gate_enabled", False)
+            and self.config["motion"]["enabled"]
+            and len(self.last_motion_detections["bboxes"]) == 0
+            and time.time() - self.last_yolo_ts < detection_config.get("motion_gate_max_age", 2.0)
+        )
+        
+    def _request_detection(self, frame):
+        """Hand a frame to the batched detector and wait for its detections"""
+        detections = self.detection_worker.submit(self.stream_id, frame, lambda: self.running)
+        if detections is None:
+            return self.last_object_detections
+        return detections
+        
+    def _annotate_frame(self, frame, detections, labels=False):
+        bboxes, confs, types = detections["bboxes"], detections["confs"], detections["types"]
+        colors = COLOR_TABLE[types]
+        draw_boxes(frame, bboxes, colors)
+        
+        # Text rendering is slow, so labels are only drawn for on-demand snapshots
+        if labels:
+            names = LABEL_TABLE[types]
+            for i in range(len(bboxes)):
+                x1, y1 = bboxes[i, :2].tolist()
+                cv2.putText(frame, f"{names[i]} {confs[i]:.2f}", (x1, y1 - 10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, colors[i].tolist(), 2)
             
         return frame
         
+    def _publish_jpeg(self, jpeg):
+        with self.jpeg_cond:
+            self.latest_jpeg = jpeg
+            self.jpeg_seq += 1
+            self.jpeg_cond.notify_all()
+            listeners = list(self.jpeg_listeners)
+        for listener in listeners:
+            listener()
+            
+    def add_jpeg_listener(self, listener):
+        with self.jpeg_cond:
+            self.jpeg_listeners.append(listener)
+            
+    def remove_jpeg_listener(self, listener):
+        with self.jpeg_cond:
+            self.jpeg_listeners.remove(listener)
+            
+    def get_latest_jpeg(self):
+        """
+        Newest published JPEG without waiting, for feeds woken through a listener
+        Returns: (jpeg bytes, sequence number)
+        """
+        self.last_feed_ts = time.time()  # Keeps annotation running while the feed is open
+        with self.jpeg_cond:
+            return self.latest_jpeg, self.jpeg_seq
+            
+    def get_snapshot_jpeg(self):
+        """
+        Latest annotated JPEG. Reuses the feed's JPEG while a feed keeps it fresh, otherwise
+        renders one on demand so snapshot polling doesn't keep the stream annotating
+        """
+        if self.latest_jpeg and self._has_viewers():
+            return self.latest_jpeg
+            
+        result = self.get_latest_result(annotated=True)
+        return encode_jpeg(result["frame"], self._jpeg_quality())
+        
+    def wait_for_jpeg(self, last_seq, timeout=1.0):
+        """
+        Block until a JPEG newer than last_seq is published
+        Returns: (jpeg bytes, sequence number), jpeg is None on timeout or stop
+        """
+        self.last_feed_ts = time.time()  # Keeps annotation running while the feed is open
+        with self.jpeg_cond:
+            self.jpeg_cond.wait_for(lambda: self.jpeg_seq != last_seq or not self.running, timeout)
+            if self.jpeg_seq == last_seq:
+                return None, last_seq
+            return self.latest_jpeg, self.jpeg_seq
+            
     def get_latest_frame(self):
-        if self.latest_frame is None:
+        frame = self.frames.peek()
+        if frame is None:
             # Return a blank frame if no frame is available
             return np.zeros((480, 640, 3), dtype=np.uint8)
-        return self.latest_frame
+        return frame
         
-    def get_latest_result(self):
-        if self.result_queue.empty():
-            return None
-        return self.result_queue.queue[-1]  # Get latest without removing
+    def get_latest_result(self, annotated=False):
+        """
+        Latest {timestamp, detections} result, or None before the first one. With annotated=True
+        a "frame" entry is added: the newest frame, rendered with those detections now, so
+        annotation is only paid for by callers that want pixels. Never None in that case
+        """
+        with self._result_lock:
+            result = self._latest_result
+        if not annotated:
+            return result
+            
+        frame = self.get_latest_frame()
+        if result is None:
+            return {"timestamp": time.time(), "detections": make_detections(), "frame": frame}
+        self._annotate_frame(frame, result["detections"], labels=True)
+        return dict(result, frame=frame)
         
     def get_status(self):
         status = {
@@ -356,34 +1471,19 @@ class StreamProcessor:
 
 def draw_detections(frame, result):
     """Draw detections and motion on a frame"""
+    detections = result["detections"]
     
-    # Draw object detections (people)
-    if result.get("detections"):
-        for det in result["detections"]:
-            x1, y1, x2, y2 = det["bbox"]
-            label = det["label"]
-            conf = det["confidence"]
-            
-            # Green box for people
-            color = (0, 255, 0)
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+    for bbox, conf, color, name in zip(detections["bboxes"].tolist(),
+                                       detections["confs"].tolist(),
+                                       COLOR_TABLE[detections["types"]].tolist(),
+                                       LABEL_TABLE[detections["types"]].tolist()):
+        x1, y1, x2, y2 = bbox
+        label_text = f"{name}: {conf:.2f}"
             
-            # Add label
-            label_text = f"{label}: {conf:.2f}"
-            cv2.putText(frame, label_text, (x1, y1 - 10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-
-    # Draw motion regions
-    if result.get("motion"):
-        for mot in result["motion"]:
-            x1, y1, x2, y2 = mot["bbox"]
-            
-            # Red box for motion
-            color = (0, 0, 255)
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            
-            # Add label
-            cv2.putText(frame, "motion", (x1, y1 - 10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        
+        # Add label
+        cv2.putText(frame, label_text, (x1, y1 - 10), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
                         
-    return frame
\ No newline at end of file
+    return frame